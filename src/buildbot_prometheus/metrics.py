@@ -0,0 +1,332 @@
+"""
+Lightweight metrics backed by plain dicts.
+
+The metric classes of prometheus_client take a lock and allocate a value
+object for every labelled child. All of the reporter's metric updates happen
+on the reactor thread, so the metrics here instead keep the value of each
+series in a dict keyed by its tuple of label values. They are exposed to
+prometheus_client through a single ``MetricsCollector`` that builds the
+metric families from those dicts only when the registry is collected.
+
+The collector can also write the Prometheus text exposition format itself,
+see ``MetricsCollector.render``, which is what the reporter serves. The
+writing can be done on another thread from a snapshot of the metrics taken
+on the reactor thread, see ``MetricsCollector.snapshot``.
+"""
+
+from bisect import bisect_left
+from collections import defaultdict
+
+from prometheus_client.core import (
+    CounterMetricFamily,
+    GaugeMetricFamily,
+    HistogramMetricFamily,
+)
+from prometheus_client.registry import Collector
+from prometheus_client.utils import floatToGoString
+
+
+def _escape_label_value(value):
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _escape_help(text):
+    return text.replace("\\", r"\\").replace("\n", r"\n")
+
+
+def _format_value(value):
+    """Format a sample value as prometheus_client does"""
+    return floatToGoString(value).encode("ascii")
+
+
+def _format_count(count):
+    """Format an integral sample value as prometheus_client does"""
+    # Counts below a million print as "<count>.0", larger ones in exponent
+    # notation, just as Go's formatting of floats does.
+    if count < 1000000:
+        return b"%d.0" % count
+    return _format_value(count)
+
+
+class _Metric:
+    """
+    The series of a metric, keyed by tuples of label values given in the
+    order of labelnames. Unlabelled metrics have a single series keyed by
+    the empty tuple.
+
+    Each series records the expiry generation it was last updated in so that
+    series which are no longer updated can be removed by ``expire``. The
+    exposition text preceding the value of each series is formatted once and
+    kept in ``prefixes`` until the series is removed.
+
+    Subclasses define ``kind``, the metric type written on the ``# TYPE``
+    line, and implement:
+
+    - ``_prefix(labelvalues)``, returning the preformatted prefix of a series;
+    - ``_write_series(buf, series)``, appending the samples of a snapshot of
+      the series, as (prefix, value) pairs, to the bytearray buf;
+    - ``family()``, returning the prometheus_client metric family of the
+      metric for ``MetricsCollector.collect``.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), expires=True):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # An unlabelled metric only ever has one series so it never expires.
+        self.expires = expires and bool(self.labelnames)
+        self.values = defaultdict(self._new_value)
+        self.touched = {}
+        self.generation = 0
+        self.prefixes = {}
+        name = self.sample_name().encode("utf-8")
+        help_text = _escape_help(documentation).encode("utf-8")
+        self._help_line = b"# HELP %s %s\n" % (name, help_text)
+        self._type_line = b"# TYPE %s %s\n" % (name, self.kind.encode("ascii"))
+
+    def _new_value(self):
+        return 0.0
+
+    def sample_name(self):
+        """Return the name of the metric as it appears in the exposition"""
+        return self.name
+
+    def _labels(self, labelvalues, extra=()):
+        """
+        Return the formatted labels of a series, and any extra (name, value)
+        pairs, each with a trailing comma. As with prometheus_client, the
+        labels are written in order of their names.
+        """
+        pairs = sorted((*zip(self.labelnames, labelvalues), *extra))
+        return "".join(
+            f'{name}="{_escape_label_value(str(value))}",' for name, value in pairs
+        )
+
+    def ensure(self, labelvalues=()):
+        """Create the series for labelvalues, at zero, if it does not exist"""
+        self.values[labelvalues]  # pylint: disable=pointless-statement
+        self.touched[labelvalues] = self.generation
+
+    def expire(self, generations):
+        """
+        Start a new expiry generation and remove the series that have not
+        been updated within the last ``generations`` generations.
+        """
+        self.generation += 1
+        if not self.expires:
+            return
+        oldest = self.generation - generations
+        stale = [key for key, touched in self.touched.items() if touched < oldest]
+        for key in stale:
+            del self.touched[key]
+            del self.values[key]
+            self.prefixes.pop(key, None)
+
+    def _copy_value(self, value):
+        return value
+
+    def snapshot(self):
+        """
+        Return a list of (prefix, value) pairs, one per series, holding a
+        copy of the current value of each series.
+
+        The prefixes of new series are formatted here so that writing the
+        snapshot never modifies the metric.
+        """
+        prefixes = self.prefixes
+        copy_value = self._copy_value
+        series = []
+        for labelvalues, value in self.values.items():
+            prefix = prefixes.get(labelvalues)
+            if prefix is None:
+                prefix = prefixes[labelvalues] = self._prefix(labelvalues)
+            series.append((prefix, copy_value(value)))
+        return series
+
+    def write(self, buf, series, include_help=False):
+        """
+        Append the exposition text of the metric for a snapshot of its series
+        to the bytearray buf.
+        """
+        if include_help:
+            buf += self._help_line
+        buf += self._type_line
+        self._write_series(buf, series)
+
+
+class _Scalar(_Metric):
+    """A metric holding a single value per series"""
+
+    family_class = None
+
+    def inc(self, labelvalues=(), amount=1):
+        self.values[labelvalues] += amount
+        self.touched[labelvalues] = self.generation
+
+    def family(self):
+        family = self.family_class(
+            self.name, self.documentation, labels=self.labelnames
+        )
+        for labelvalues, value in self.values.items():
+            family.add_metric([str(v) for v in labelvalues], value)
+        return family
+
+    def _prefix(self, labelvalues):
+        name = self.sample_name()
+        if not labelvalues:
+            return f"{name} ".encode("utf-8")
+        return f"{name}{{{self._labels(labelvalues)[:-1]}}} ".encode("utf-8")
+
+    def _write_series(self, buf, series):
+        for prefix, value in series:
+            buf += prefix
+            buf += _format_value(value)
+            buf += b"\n"
+
+
+class Counter(_Scalar):
+    """A counter metric"""
+
+    kind = "counter"
+    family_class = CounterMetricFamily
+
+    def sample_name(self):
+        # As with prometheus_client, the exposed name always ends in _total.
+        if self.name.endswith("_total"):
+            return self.name
+        return f"{self.name}_total"
+
+
+class Gauge(_Scalar):
+    """A gauge metric. Gauges are decreased by a negative inc amount."""
+
+    kind = "gauge"
+    family_class = GaugeMetricFamily
+
+
+class Histogram(_Metric):
+    """
+    A histogram metric. The value of each series is a list holding the
+    number of observations that fell in each bucket, non-cumulatively,
+    followed by the sum of all observations.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=(), **kwargs):
+        upper_bounds = sorted(float(b) for b in buckets)
+        if not upper_bounds or upper_bounds[-1] != float("inf"):
+            upper_bounds.append(float("inf"))
+        self.upper_bounds = tuple(upper_bounds)
+        self._bucket_labels = tuple(floatToGoString(b) for b in upper_bounds)
+        _Metric.__init__(self, name, documentation, labelnames, **kwargs)
+
+    def _new_value(self):
+        return [0] * len(self.upper_bounds) + [0.0]
+
+    def _copy_value(self, value):
+        return tuple(value)
+
+    def observe(self, labelvalues, value):
+        series = self.values[labelvalues]
+        # An observation equal to an upper bound belongs in that bucket.
+        series[bisect_left(self.upper_bounds, value)] += 1
+        series[-1] += value
+        self.touched[labelvalues] = self.generation
+
+    def family(self):
+        family = HistogramMetricFamily(
+            self.name, self.documentation, labels=self.labelnames
+        )
+        for labelvalues, series in self.values.items():
+            buckets = []
+            cumulative = 0
+            for bucket_label, count in zip(self._bucket_labels, series):
+                cumulative += count
+                buckets.append((bucket_label, cumulative))
+            family.add_metric([str(v) for v in labelvalues], buckets, series[-1])
+        return family
+
+    def _prefix(self, labelvalues):
+        """
+        Return the prefixes of a series: one per bucket followed by those of
+        the count and the sum.
+        """
+        name = self.name
+        prefixes = []
+        for bucket_label in self._bucket_labels:
+            labels = self._labels(labelvalues, [("le", bucket_label)])
+            prefixes.append(f"{name}_bucket{{{labels[:-1]}}} ".encode("utf-8"))
+        labels = self._labels(labelvalues)
+        labels = f"{{{labels[:-1]}}}" if labels else ""
+        prefixes.append(f"{name}_count{labels} ".encode("utf-8"))
+        prefixes.append(f"{name}_sum{labels} ".encode("utf-8"))
+        return tuple(prefixes)
+
+    def _write_series(self, buf, series):
+        for prefixes, value in series:
+            cumulative = 0
+            for prefix, count in zip(prefixes, value[:-1]):
+                cumulative += count
+                buf += prefix
+                buf += _format_count(cumulative)
+                buf += b"\n"
+            buf += prefixes[-2]
+            buf += _format_count(cumulative)
+            buf += b"\n"
+            buf += prefixes[-1]
+            buf += _format_value(value[-1])
+            buf += b"\n"
+
+
+class MetricsCollector(Collector):
+    """Expose a set of metrics to a prometheus_client registry"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        """Add a metric to the collector and return it"""
+        self.metrics.append(metric)
+        return metric
+
+    def expire(self, generations):
+        """Expire the stale series of every metric. See ``_Metric.expire``."""
+        for metric in self.metrics:
+            metric.expire(generations)
+
+    def collect(self):
+        for metric in self.metrics:
+            yield metric.family()
+
+    def snapshot(self):
+        """
+        Return a snapshot of every metric for ``render_snapshot``.
+
+        This must be called on the thread updating the metrics. The snapshot
+        shares no mutable state with the metrics so it can then be rendered
+        on any thread.
+        """
+        return [(metric, metric.snapshot()) for metric in self.metrics]
+
+    @staticmethod
+    def render_snapshot(snapshot, include_help=False):
+        """
+        Return a snapshot in the Prometheus text exposition format.
+
+        This is equivalent to ``generate_latest`` for a registry holding only
+        this collector but writes into a single buffer using the preformatted
+        prefix of each series. The ``# TYPE`` line of each metric is always
+        written, as Prometheus needs it to know the type of a metric, while
+        the ``# HELP`` lines are only written when include_help is true.
+        """
+        buf = bytearray()
+        for metric, series in snapshot:
+            metric.write(buf, series, include_help)
+        return bytes(buf)
+
+    def render(self, include_help=False):
+        """Return the metrics in the Prometheus text exposition format"""
+        return self.render_snapshot(self.snapshot(), include_help)
@@ -24,6 +24,11 @@ easier to find in metrics consumer and visualisation tools such as Grafana.
 All duration metrics use seconds as the unit of measure.
 """
 
+import sys
+from collections import OrderedDict
+from datetime import datetime
+from functools import partial
+
 from buildbot.process.results import (
     CANCELLED,
     EXCEPTION,
@@ -34,12 +39,11 @@ from buildbot.process.results import (
     WARNINGS,
 )
 from buildbot.util import service
-from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
-from prometheus_client.twisted import MetricsResource
-from twisted.internet import defer, reactor
+from prometheus_client import CollectorRegistry
+from twisted.internet import defer, reactor, task
 from twisted.python import log
-from twisted.web.resource import Resource
-from twisted.web.server import Site
+
+from .metrics import Counter, Gauge, Histogram, MetricsCollector
 
 ResultsStatusMap = {
     SUCCESS: "success",
@@ -52,9 +56,71 @@ ResultsStatusMap = {
 }
 
 
+# Histogram bucket boundaries, in seconds, for the duration metrics. Build
+# sets and build requests span whole builds so share the build buckets. Both
+# can be overridden with the build_duration_buckets and step_duration_buckets
+# arguments of the reporter.
+BuildDurationBuckets = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, float("inf"))
+StepDurationBuckets = (0.1, 0.5, 1, 5, 30, 60, 300, 1800, float("inf"))
+
+# The mq routing key actions the consumers subscribe to. Each consumer only
+# handles a single action, so the mq filters out every other event and the
+# consumers never need to check the action themselves. The finished and
+# complete actions are only sent once the build, buildset, build request or
+# step is complete, so the complete_at of their messages is always set.
+_FINISHED = "finished"
+_COMPLETE = "complete"
+_STARTED = "started"
+_STOPPED = "stopped"
+_CONNECTED = "connected"
+_DISCONNECTED = "disconnected"
+
+
+def _to_seconds(started, finished):
+    """
+    Return the number of seconds between two times. Times may be datetime
+    objects or epoch seconds, in which case no timedelta is created.
+    """
+    if isinstance(finished, datetime):
+        return (finished - started).total_seconds()
+    return finished - started
+
+
+# Bound once to avoid an attribute lookup per call.
+_resolve_status = ResultsStatusMap.get
+
+
 def resolve_results_status(state):
     """Resolve the results status to one of success, failure or error"""
-    return ResultsStatusMap.get(state, "error")
+    return _resolve_status(state, "error")
+
+
+# The result counters of builds, buildsets, build requests and steps are held
+# as (success, failure, error) tuples of bound inc methods. Buildbot results
+# are small consecutive ints, so this tuple is indexed by the results value
+# and holds the position of the counter it increments within such a tuple,
+# or None for results that are not counted (e.g. RETRY).
+_ERROR_INDEX = 2
+_status_index = {"success": 0, "failure": 1, "error": _ERROR_INDEX}
+_results_index = tuple(
+    _status_index.get(resolve_results_status(results))
+    for results in range(max(ResultsStatusMap) + 1)
+)
+
+
+def _result_position(results):
+    """
+    Return the position of the counter that counts results within a
+    (success, failure, error) tuple of result counters, or None if results
+    are not counted. Unknown and missing results are counted as errors, as
+    resolve_results_status resolves them.
+    """
+    try:
+        if results >= 0:
+            return _results_index[results]
+    except (IndexError, TypeError):
+        pass
+    return _ERROR_INDEX
 
 
 class Prometheus(service.BuildbotService):
@@ -71,18 +137,72 @@ class Prometheus(service.BuildbotService):
     - Histogram: h_<attr_label>
     - Summary: s_<attr_label>
 
+    The metrics are the plain dict backed metrics of the ``metrics`` module,
+    exposed through a single collector. They take no locks as they are only
+    ever updated, and snapshotted for scrapes, on the reactor thread, so they
+    must not be accessed from any other thread. Only the rendering of those
+    snapshots happens in the threadpool.
     """
 
     name = "Prometheus"
     namespace = "buildbot"
-
-    def __init__(self, port=9100, interface="", **kwargs):
+    build_info_cache_size = 4096
+    # How often, in seconds, series are checked for expiry. See label_expiry.
+    label_expiry_interval = 300
+
+    def __init__(
+        self,
+        port=9100,
+        interface="",
+        cache_ttl=1.0,
+        build_duration_buckets=BuildDurationBuckets,
+        step_duration_buckets=StepDurationBuckets,
+        step_name_metrics=False,
+        label_expiry=7 * 24 * 3600,
+        **kwargs,
+    ):
         service.BuildbotService.__init__(self, **kwargs)
         self.port = port
         self.interface = interface
+        self.cache_ttl = cache_ttl
+        self.build_duration_buckets = tuple(build_duration_buckets)
+        self.step_duration_buckets = tuple(step_duration_buckets)
+        self.step_name_metrics = step_name_metrics
+        # Series of labelled metrics that have not been updated for this many
+        # seconds are removed so that series for builders and workers that no
+        # longer exist do not accumulate forever. It is measured in days as a
+        # series that expires between two builds of a builder comes back at 1,
+        # which Prometheus sees as a new series rather than an increase.
+        self.label_expiry = label_expiry
+        # The series created by _warmLabels for the builders and workers
+        # configured on this master, which are never expired.
+        self._warm_series = ()
         self.server = None
+        self.metrics_resource = None
+        self.expiry_loop = None
         self.consumers = []
         self.registry = None
+        self.collector = None
+        self._build_info_cache = OrderedDict()
+        self._build_info_pending = {}
+        # Builds that finished while their ids were being fetched.
+        self._build_info_finished = set()
+        # Each topic and action is subscribed to separately, directly with its
+        # consumer, so that the mq only delivers messages that are actually
+        # consumed. The running gauge consumers are bound to the change the
+        # action makes to the gauges.
+        builders_consumer = self.buildersConsumer
+        workers_consumer = self.workersConsumer
+        self._handlers = (
+            (("builds", None, _FINISHED), self.buildsConsumer),
+            (("builders", None, _STARTED), partial(builders_consumer, delta=1)),
+            (("builders", None, _STOPPED), partial(builders_consumer, delta=-1)),
+            (("buildsets", None, _COMPLETE), self.buildSetsConsumer),
+            (("buildrequests", None, _COMPLETE), self.buildRequestsConsumer),
+            (("steps", None, _FINISHED), self.stepsConsumer),
+            (("workers", None, _CONNECTED), partial(workers_consumer, delta=1)),
+            (("workers", None, _DISCONNECTED), partial(workers_consumer, delta=-1)),
+        )
         self.create_metrics()
 
     @defer.inlineCallbacks
@@ -92,20 +212,41 @@ class Prometheus(service.BuildbotService):
         """
         log.msg("Reconfiguring Prometheus reporter")
         yield service.BuildbotService.reconfigService(self)
-        self.registerConsumers()
+        yield self.registerConsumers()
+        # Warming only creates zero valued series ahead of the first events,
+        # so failing to do so must not fail the reconfig.
+        try:
+            yield self._warmLabels()
+        except Exception:  # pylint: disable=broad-except
+            log.err(None, "Failed to warm Prometheus labels")
 
     @defer.inlineCallbacks
     def startService(self):
+        # The HTTP serving stack is only imported once the service actually
+        # starts, keeping it out of the import of the reporters plugin.
+        from twisted.web.resource import Resource
+        from twisted.web.server import Site
+
+        from .resources import CachedMetricsResource
+
         log.msg("Starting Prometheus reporter")
         yield service.BuildbotService.startService(self)
         root = Resource()
-        root.putChild(b"metrics", MetricsResource(registry=self.registry))
+        # The rendered output, and its gzip compressed form for scrapes that
+        # accept it, is reused by scrapes arriving within cache_ttl seconds of
+        # each other.
+        self.metrics_resource = CachedMetricsResource(self.collector, self.cache_ttl)
+        root.putChild(b"metrics", self.metrics_resource)
         self.server = reactor.listenTCP(self.port, Site(root), interface=self.interface)
         log.msg("Prometheus service starting on {}".format(self.server.port))
+        self.expiry_loop = task.LoopingCall(self._expireLabels)
+        self.expiry_loop.start(self.label_expiry_interval, now=False)
 
     @defer.inlineCallbacks
     def stopService(self):
         log.msg("Stopping Prometheus reporter")
+        if self.expiry_loop is not None and self.expiry_loop.running:
+            self.expiry_loop.stop()
         yield self.server.stopListening()
         yield service.BuildbotService.stopService(self)
         self.removeConsumers()
@@ -115,188 +256,329 @@ class Prometheus(service.BuildbotService):
         Create the Prometheus metrics that will be exposed.
         """
         log.msg("Creating Prometheus metrics")
-        self.registry = CollectorRegistry()
-
-        # build metrics
+        # The metrics endpoint is rendered by the collector itself. It is also
+        # registered on a private registry, rather than prometheus_client's
+        # REGISTRY with its process, platform and gc collectors, so that the
+        # metrics remain available through the prometheus_client API. The
+        # collector has no describe method, so auto_describe is disabled to
+        # stop registration collecting it just to check for duplicate names.
+        self.registry = CollectorRegistry(auto_describe=False)
+        self.collector = MetricsCollector()
+        self.registry.register(self.collector)
+        add = self.collector.add
+        ns = self.namespace
+
+        # The consumers pass label values positionally as tuple keys, so the
+        # order of each labels list below is relied upon by the consumers.
+
+        # build metrics, keyed by (builderid, workerid). The duration is only
+        # keyed by (builderid,) to keep the number of histogram series down.
         builds_labels = ["builder_id", "worker_id"]
-        self.g_builds_duration = Gauge(
-            "builds_duration_seconds",
-            "Number of seconds spent performing builds",
-            labelnames=builds_labels,
-            namespace=self.namespace,
-            registry=self.registry,
+        self.h_builds_duration = add(
+            Histogram(
+                f"{ns}_builds_duration_seconds",
+                "Number of seconds spent performing builds",
+                labelnames=["builder_id"],
+                buckets=self.build_duration_buckets,
+            )
         )
-        self.c_builds_success = Counter(
-            "builds_success",
-            "Number of builds reporting success",
-            labelnames=builds_labels,
-            namespace=self.namespace,
-            registry=self.registry,
+        self.c_builds_success = add(
+            Counter(
+                f"{ns}_builds_success",
+                "Number of builds reporting success",
+                labelnames=builds_labels,
+            )
         )
-        self.c_builds_failure = Counter(
-            "builds_failure",
-            "Number of builds reporting failure",
-            labelnames=builds_labels,
-            namespace=self.namespace,
-            registry=self.registry,
+        self.c_builds_failure = add(
+            Counter(
+                f"{ns}_builds_failure",
+                "Number of builds reporting failure",
+                labelnames=builds_labels,
+            )
         )
-        self.c_builds_error = Counter(
-            "builds_error",
-            "Number of builds reporting error",
-            labelnames=builds_labels,
-            namespace=self.namespace,
-            registry=self.registry,
+        self.c_builds_error = add(
+            Counter(
+                f"{ns}_builds_error",
+                "Number of builds reporting error",
+                labelnames=builds_labels,
+            )
+        )
+        self._builds_results = (
+            self.c_builds_success.inc,
+            self.c_builds_failure.inc,
+            self.c_builds_error.inc,
         )
 
-        # builders metrics
+        # builders metrics, keyed by (builderid, name). The running gauges
+        # hold state rather than the outcome of the last event so their
+        # series must never be expired.
         builders_labels = ["builder_id", "builder_name"]
-        self.g_builders_running_total = Gauge(
-            "builders_running_total",
-            "Total number of builders running",
-            namespace=self.namespace,
-            registry=self.registry,
+        self.g_builders_running_total = add(
+            Gauge(
+                f"{ns}_builders_running_total",
+                "Total number of builders running",
+            )
         )
-        self.g_builders_running = Gauge(
-            "builders_running",
-            "Number of builders running",
-            labelnames=builders_labels,
-            namespace=self.namespace,
-            registry=self.registry,
+        self.g_builders_running = add(
+            Gauge(
+                f"{ns}_builders_running",
+                "Number of builders running",
+                labelnames=builders_labels,
+                expires=False,
+            )
         )
-
-        # buildsets metrics
-        buildsets_labels = ["buildset_id"]
-        self.g_buildsets_duration = Gauge(
-            "buildsets_duration_seconds",
-            "Number of seconds spent performing buildsets",
-            labelnames=buildsets_labels,
-            namespace=self.namespace,
-            registry=self.registry,
+        # Running totals are decreased by incrementing with a negative delta.
+        self._builders_total_inc = self.g_builders_running_total.inc
+
+        # buildsets metrics. These are deliberately unlabelled as the
+        # buildset id increments forever and would create a new series for
+        # every buildset ever submitted.
+        self.h_buildsets_duration = add(
+            Histogram(
+                f"{ns}_buildsets_duration_seconds",
+                "Number of seconds spent performing buildsets",
+                buckets=self.build_duration_buckets,
+            )
+        )
+        self.c_buildsets_success = add(
+            Counter(
+                f"{ns}_buildsets_success",
+                "Number of buildsets reporting success",
+            )
         )
-        self.c_buildsets_success = Counter(
-            "buildsets_success",
-            "Number of buildsets reporting success",
-            labelnames=buildsets_labels,
-            namespace=self.namespace,
-            registry=self.registry,
+        self.c_buildsets_failure = add(
+            Counter(
+                f"{ns}_buildsets_failure",
+                "Number of buildsets reporting failure",
+            )
         )
-        self.c_buildsets_failure = Counter(
-            "buildsets_failure",
-            "Number of buildsets reporting failure",
-            labelnames=buildsets_labels,
-            namespace=self.namespace,
-            registry=self.registry,
+        self.c_buildsets_error = add(
+            Counter(
+                f"{ns}_buildsets_error",
+                "Number of buildsets reporting error",
+            )
         )
-        self.c_buildsets_error = Counter(
-            "buildsets_error",
-            "Number of buildsets reporting error",
-            labelnames=buildsets_labels,
-            namespace=self.namespace,
-            registry=self.registry,
+        self._buildsets_results = (
+            self.c_buildsets_success.inc,
+            self.c_buildsets_failure.inc,
+            self.c_buildsets_error.inc,
         )
 
-        # build requests metrics
+        # build requests metrics, keyed by (builderid,)
         build_requests_labels = ["builder_id"]
-        self.g_build_requests_duration = Gauge(
-            "build_requests_duration_seconds",
-            "Number of seconds spent performing build requests",
-            labelnames=build_requests_labels,
-            namespace=self.namespace,
-            registry=self.registry,
+        self.h_build_requests_duration = add(
+            Histogram(
+                f"{ns}_build_requests_duration_seconds",
+                "Number of seconds spent performing build requests",
+                labelnames=build_requests_labels,
+                buckets=self.build_duration_buckets,
+            )
         )
-        self.c_build_requests_success = Counter(
-            "build_requests_success",
-            "Number of build requests reporting success",
-            labelnames=build_requests_labels,
-            namespace=self.namespace,
-            registry=self.registry,
+        self.c_build_requests_success = add(
+            Counter(
+                f"{ns}_build_requests_success",
+                "Number of build requests reporting success",
+                labelnames=build_requests_labels,
+            )
         )
-        self.c_build_requests_failure = Counter(
-            "build_requests_failure",
-            "Number of build requests reporting failure",
-            labelnames=build_requests_labels,
-            namespace=self.namespace,
-            registry=self.registry,
+        self.c_build_requests_failure = add(
+            Counter(
+                f"{ns}_build_requests_failure",
+                "Number of build requests reporting failure",
+                labelnames=build_requests_labels,
+            )
         )
-        self.c_build_requests_error = Counter(
-            "build_requests_error",
-            "Number of build requests reporting error",
-            labelnames=build_requests_labels,
-            namespace=self.namespace,
-            registry=self.registry,
+        self.c_build_requests_error = add(
+            Counter(
+                f"{ns}_build_requests_error",
+                "Number of build requests reporting error",
+                labelnames=build_requests_labels,
+            )
+        )
+        self._build_requests_results = (
+            self.c_build_requests_success.inc,
+            self.c_build_requests_failure.inc,
+            self.c_build_requests_error.inc,
         )
 
-        # steps metrics
-        steps_labels = ["step_number", "step_name", "builder_id", "worker_id"]
-        self.g_steps_duration = Gauge(
-            "steps_duration_seconds",
-            "Number of seconds spent performing build steps",
-            labelnames=steps_labels,
-            namespace=self.namespace,
-            registry=self.registry,
+        # steps metrics, keyed by (builderid, workerid). Step names and numbers
+        # are not used as labels as every distinct step of every builder would
+        # multiply the number of series.
+        steps_labels = ["builder_id", "worker_id"]
+        self.h_steps_duration = add(
+            Histogram(
+                f"{ns}_steps_duration_seconds",
+                "Number of seconds spent performing build steps",
+                labelnames=steps_labels,
+                buckets=self.step_duration_buckets,
+            )
+        )
+        self.c_steps_success = add(
+            Counter(
+                f"{ns}_steps_success",
+                "Number of steps reporting success",
+                labelnames=steps_labels,
+            )
         )
-        self.c_steps_success = Counter(
-            "steps_success",
-            "Number of steps reporting success",
-            labelnames=steps_labels,
-            namespace=self.namespace,
-            registry=self.registry,
+        self.c_steps_failure = add(
+            Counter(
+                f"{ns}_steps_failure",
+                "Number of steps reporting failure",
+                labelnames=steps_labels,
+            )
         )
-        self.c_steps_failure = Counter(
-            "steps_failure",
-            "Number of steps reporting failure",
-            labelnames=steps_labels,
-            namespace=self.namespace,
-            registry=self.registry,
+        self.c_steps_error = add(
+            Counter(
+                f"{ns}_steps_error",
+                "Number of steps reporting error",
+                labelnames=steps_labels,
+            )
         )
-        self.c_steps_error = Counter(
-            "steps_error",
-            "Number of steps reporting error",
-            labelnames=steps_labels,
-            namespace=self.namespace,
-            registry=self.registry,
+        self._steps_results = (
+            self.c_steps_success.inc,
+            self.c_steps_failure.inc,
+            self.c_steps_error.inc,
         )
 
-        # workers metrics
+        # Opt-in step results keyed by (name, builderid), for masters whose
+        # step names are few enough to be worth breaking the results down by.
+        self._step_names_results = None
+        if self.step_name_metrics:
+            step_names_labels = ["step_name", "builder_id"]
+            self.c_step_names_success = add(
+                Counter(
+                    f"{ns}_step_names_success",
+                    "Number of steps of each name reporting success",
+                    labelnames=step_names_labels,
+                )
+            )
+            self.c_step_names_failure = add(
+                Counter(
+                    f"{ns}_step_names_failure",
+                    "Number of steps of each name reporting failure",
+                    labelnames=step_names_labels,
+                )
+            )
+            self.c_step_names_error = add(
+                Counter(
+                    f"{ns}_step_names_error",
+                    "Number of steps of each name reporting error",
+                    labelnames=step_names_labels,
+                )
+            )
+            self._step_names_results = (
+                self.c_step_names_success.inc,
+                self.c_step_names_failure.inc,
+                self.c_step_names_error.inc,
+            )
+
+        # workers metrics, keyed by (workerid, name)
         workers_labels = ["worker_id", "worker_name"]
-        self.g_workers_running_total = Gauge(
-            "workers_running_total",
-            "Total number of workers running",
-            namespace=self.namespace,
-            registry=self.registry,
+        self.g_workers_running_total = add(
+            Gauge(
+                f"{ns}_workers_running_total",
+                "Total number of workers running",
+            )
         )
-        self.g_workers_running = Gauge(
-            "workers_running",
-            "Number of workers running",
-            labelnames=workers_labels,
-            namespace=self.namespace,
-            registry=self.registry,
+        self.g_workers_running = add(
+            Gauge(
+                f"{ns}_workers_running",
+                "Number of workers running",
+                labelnames=workers_labels,
+                expires=False,
+            )
         )
+        self._workers_total_inc = self.g_workers_running_total.inc
+
+    @defer.inlineCallbacks
+    def _warmLabels(self):
+        """
+        Create the series for the builders and workers configured on this
+        master. This exposes the result counters of every configured builder
+        and worker pairing at zero before the first event arrives, and keeps
+        them from expiring while the builders and workers stay configured.
+
+        Only builders and workers configured on this master are fetched, as
+        the data API otherwise returns every builder and worker ever stored
+        in the database. The running gauges are not warmed as their series
+        never expire.
+        """
+        masterid = self.master.masterid
+        builders = yield self.master.data.get(("masters", masterid, "builders"))
+        workers = yield self.master.data.get(("masters", masterid, "workers"))
+        build_requests_counters = (
+            self.c_build_requests_success,
+            self.c_build_requests_failure,
+            self.c_build_requests_error,
+        )
+        builds_counters = (
+            self.c_builds_success,
+            self.c_builds_failure,
+            self.c_builds_error,
+        )
+        warm_series = []
+        for builder in builders:
+            labels = (builder["builderid"],)
+            warm_series.extend((counter, labels) for counter in build_requests_counters)
+        for worker in workers:
+            for configured in worker["configured_on"]:
+                if configured["masterid"] != masterid:
+                    continue
+                labels = (configured["builderid"], worker["workerid"])
+                warm_series.extend((counter, labels) for counter in builds_counters)
+        for counter, labels in warm_series:
+            counter.ensure(labels)
+        self._warm_series = tuple(warm_series)
+
+    def _expireLabels(self):
+        """
+        Remove series of labelled metrics that have not been updated within
+        ``label_expiry`` seconds. This bounds the metrics by the number of
+        active, rather than historical, label combinations.
+
+        Expiry is tracked in generations, one per expiry interval, so that
+        updates only record the current generation rather than a timestamp.
+
+        The series created for the builders and workers configured on this
+        master at the last reconfig are kept however long they have been idle.
+        """
+        for counter, labels in self._warm_series:
+            counter.ensure(labels)
+        generations = max(1, round(self.label_expiry / self.label_expiry_interval))
+        self.collector.expire(generations)
 
     @defer.inlineCallbacks
     def registerConsumers(self):
         self.removeConsumers()
         startConsuming = self.master.mq.startConsuming
 
-        handlers = (
-            (("builds", None, None), self.buildsConsumer),
-            (("builders", None, None), self.buildersConsumer),
-            (("buildsets", None, None), self.buildSetsConsumer),
-            (("buildrequests", None, None), self.buildRequestsConsumer),
-            (("steps", None, None), self.stepsConsumer),
-            (("workers", None, None), self.workersConsumer),
+        # The subscriptions are independent so are started concurrently. Those
+        # that started are kept, even if another failed, so that they can be
+        # stopped by removeConsumers.
+        results = yield defer.DeferredList(
+            [
+                defer.maybeDeferred(startConsuming, handler, routingKey)
+                for routingKey, handler in self._handlers
+            ],
+            consumeErrors=True,
         )
-        for routingKey, handler in handlers:
-            consumer = yield startConsuming(handler, routingKey)
-            self.consumers.append(consumer)
+        failures = []
+        for success, result in results:
+            if success:
+                self.consumers.append(result)
+            else:
+                failures.append(result)
+        if failures:
+            failures[0].raiseException()
 
     @defer.inlineCallbacks
     def removeConsumers(self):
-        for consumer in self.consumers:
-            yield consumer.stopConsuming()
-        self.consumers = []
+        consumers, self.consumers = self.consumers, []
+        yield defer.gatherResults(
+            [defer.maybeDeferred(consumer.stopConsuming) for consumer in consumers],
+            consumeErrors=True,
+        )
 
-    # @defer.inlineCallbacks
     def buildsConsumer(self, key, msg):
         """
         This method is responsible for updating build related metrics. There
@@ -307,38 +589,31 @@ class Prometheus(service.BuildbotService):
         - buildbot_builds_failure,
         - buildbot_builds_error
 
-        buildbot_builds_duration_seconds is a gauge metric used to
-        track the duration of individual builds by making use of Prometheus
-        multi dimensional labels. As builds complete, an instance of this
-        metric is created by passing builder_id and worker_id labels and
-        then setting the value. This allows visualisation tools to query and
-        filter metrics for specific builder combinations.
+        buildbot_builds_duration_seconds is a histogram metric used to
+        track the distribution of build durations by making use of Prometheus
+        multi dimensional labels. As builds complete, the duration is observed
+        against the builder_id label. This allows visualisation tools to
+        compute duration quantiles for specific builders.
 
         Similarly, the other counter metrics record success, failure and
-        error states for each build.
+        error states for each build using builder_id and worker_id labels.
         """
-        action = key[2]
-        labels = dict(builder_id=msg["builderid"], worker_id=msg["workerid"])
-        # build_info = yield self.master.data.get(("builds", msg['buildid']))
-
-        if action == "finished":
-
-            assert msg["complete"]
-            build_started = msg["started_at"]
-            build_finished = msg["complete_at"]
-            build_duration = build_finished - build_started
-            duration_seconds = build_duration.total_seconds()
-            self.g_builds_duration.labels(**labels).set(duration_seconds)
-
-            build_status = resolve_results_status(msg["results"])
-            if build_status == "success":
-                self.c_builds_success.labels(**labels).inc()
-            elif build_status == "failure":
-                self.c_builds_failure.labels(**labels).inc()
-            elif build_status == "error":
-                self.c_builds_error.labels(**labels).inc()
-
-    def buildersConsumer(self, key, msg):
+        # No more step events will arrive for this build. A fetch of its ids
+        # that is still in progress must not cache them once it completes.
+        buildid = msg["buildid"]
+        self._build_info_cache.pop(buildid, None)
+        if buildid in self._build_info_pending:
+            self._build_info_finished.add(buildid)
+
+        labels = (msg["builderid"], msg["workerid"])
+        duration_seconds = _to_seconds(msg["started_at"], msg["complete_at"])
+        self.h_builds_duration.observe(labels[:1], duration_seconds)
+
+        index = _result_position(msg["results"])
+        if index is not None:
+            self._builds_results[index](labels)
+
+    def buildersConsumer(self, key, msg, delta):
         """
         The Buildmaster runs a collection of Builders, each of which handles a
         single type of build (e.g. full versus quick), on one or more workers.
@@ -368,18 +643,14 @@ class Prometheus(service.BuildbotService):
         incremented. When the worker disconnects the same gauge metric is
         decreased. This means that a gauge value of 1 indicates started while
         a gauge value of 0 indicates stopped.
-        """
-        action = key[2]
-        labels = dict(builder_id=msg["builderid"], builder_name=msg["name"])
 
-        if action == "started":
-            self.g_builders_running_total.inc()
-            self.g_builders_running.labels(**labels).inc()
-        elif action == "stopped":
-            self.g_builders_running_total.dec()
-            self.g_builders_running.labels(**labels).dec()
+        The change, delta, is 1 for the started and -1 for the stopped action
+        and is bound when the consumer is subscribed.
+        """
+        labels = (msg["builderid"], msg["name"])
+        self._builders_total_inc((), delta)
+        self.g_builders_running.inc(labels, delta)
 
-    # @defer.inlineCallbacks
     def buildSetsConsumer(self, key, msg):
         """
         A BuildSet is the name given to a set of Builds that all compile/test
@@ -400,41 +671,22 @@ class Prometheus(service.BuildbotService):
         - buildbot_buildsets_failure,
         - buildbot_buildsets_error
 
-        buildbot_buildsets_duration_seconds is a gauge metric used to
-        track the duration of individual build sets by making use of
-        Prometheus multi dimensional labels. As build sets complete, an
-        instance of this metric is created by passing buildset_id labels and
-        then setting the value. This allows visualisation tools to query and
-        filter metrics for specific builder combinations.
+        buildbot_buildsets_duration_seconds is a histogram metric used to
+        track the distribution of build set durations. No labels are used
+        with this metric, or the counters, because the buildset id increments
+        with every build set and would create an unbounded number of time
+        series.
 
-        Similarly, the other counter metrics record success, failure and
-        error states for each build set.
+        Similarly, the other counter metrics record the total number of
+        success, failure and error states across all build sets.
 
         """
-        action = key[2]
-        # TODO: substitute bsid for something more useful. bsid is just
-        # a number that increments. A better choice would be something
-        # like the repo, project, etc
-        labels = dict(buildset_id=msg["bsid"])
-
-        # buildset_info = yield self.master.data.get(("buildsets", msg['bsid']))
-
-        if action == "complete":
-
-            assert msg["complete"]
-            buildset_started = msg["submitted_at"]
-            buildset_finished = msg["complete_at"]
-            buildset_duration = buildset_finished - buildset_started
-            duration_seconds = buildset_duration.total_seconds()
-            self.g_buildsets_duration.labels(**labels).set(duration_seconds)
-
-            bs_success = resolve_results_status(msg["results"])
-            if bs_success == "success":
-                self.c_buildsets_success.labels(**labels).inc()
-            elif bs_success == "failure":
-                self.c_buildsets_failure.labels(**labels).inc()
-            elif bs_success == "error":
-                self.c_buildsets_error.labels(**labels).inc()
+        duration_seconds = _to_seconds(msg["submitted_at"], msg["complete_at"])
+        self.h_buildsets_duration.observe((), duration_seconds)
+
+        index = _result_position(msg["results"])
+        if index is not None:
+            self._buildsets_results[index]()
 
     def buildRequestsConsumer(self, key, msg):
         """
@@ -450,36 +702,24 @@ class Prometheus(service.BuildbotService):
         - buildbot_build_requests_failure
         - buildbot_build_requests_error
 
-        buildbot_build_requests_duration_seconds is a gauge metric used to
-        track the duration of individual build requests by making use of
-        Prometheus multi dimensional labels. As build requests complete, an
-        instance of this metric is created by passing builder_id labels and
-        then setting the value. This allows visualisation tools to query and
-        filter metrics for specific builder combinations.
+        buildbot_build_requests_duration_seconds is a histogram metric used
+        to track the distribution of build request durations by making use of
+        Prometheus multi dimensional labels. As build requests complete, the
+        duration is observed against the builder_id label. This allows
+        visualisation tools to compute duration quantiles for specific
+        builders.
 
         Similarly, the other counter metrics record success, failure and
         error states for each build request.
         """
-        action = key[2]
-        labels = dict(builder_id=msg["builderid"])
-
-        if action == "complete":
-            assert msg["complete"]
-            br_started = msg["submitted_at"]
-            br_finished = msg["complete_at"]
-            br_duration = br_finished - br_started
-            duration_seconds = br_duration.total_seconds()
-            self.g_build_requests_duration.labels(**labels).set(duration_seconds)
-
-            br_success = resolve_results_status(msg["results"])
-            if br_success == "success":
-                self.c_build_requests_success.labels(**labels).inc()
-            elif br_success == "failure":
-                self.c_build_requests_failure.labels(**labels).inc()
-            elif br_success == "error":
-                self.c_build_requests_error.labels(**labels).inc()
+        labels = (msg["builderid"],)
+        duration_seconds = _to_seconds(msg["submitted_at"], msg["complete_at"])
+        self.h_build_requests_duration.observe(labels, duration_seconds)
+
+        index = _result_position(msg["results"])
+        if index is not None:
+            self._build_requests_results[index](labels)
 
-    @defer.inlineCallbacks
     def stepsConsumer(self, key, msg):
         """
         This method is responsible for updating step related metrics. There
@@ -490,45 +730,87 @@ class Prometheus(service.BuildbotService):
         - buildbot_steps_failure
         - buildbot_steps_error
 
-        buildbot_steps_duration_seconds is a gauge metric used to track
-        the duration of individual steps by making use of Prometheus multi
-        dimensional labels. As steps complete, an instance of this metric is
-        created by passing step_number, step_name, builder_id and worker_id
-        labels and then setting the value. This allows visualisation tools
-        to query and filter metrics for specific step, builder and worker
-        combinations.
+        buildbot_steps_duration_seconds is a histogram metric used to track
+        the distribution of step durations by making use of Prometheus multi
+        dimensional labels. As steps complete, the duration is observed
+        against the builder_id and worker_id labels. This allows
+        visualisation tools to compute duration quantiles for specific
+        builders and workers.
 
         Similarly, the other counter metrics record success, failure and
-        error states for each step.
-        """
-        action = key[2]
+        error states for each step using builder_id and worker_id labels.
 
-        build_info = yield self.master.data.get(("builds", msg["buildid"]))
+        When the reporter is created with ``step_name_metrics=True`` the
+        buildbot_step_names_success, buildbot_step_names_failure and
+        buildbot_step_names_error counters also record the states of each
+        step using step_name and builder_id labels.
+        """
+        # Every step of a build shares the same builder and worker so only
+        # fetch the build once and remember the ids for subsequent steps. The
+        # common case of a cached build is handled without a Deferred. The
+        # cache is kept in least recently used order so that long running
+        # builds are not evicted by bursts of short ones.
+        build_ids = self._build_info_cache.get(msg["buildid"])
+        if build_ids is None:
+            return self._stepsConsumerFetch(msg)
+        self._build_info_cache.move_to_end(msg["buildid"])
+        self._handleStep(msg, build_ids)
+        return None
+
+    def _stepsConsumerFetch(self, msg):
+        """
+        Update the step metrics once the builder and worker ids of the build
+        the step belongs to have been fetched.
 
-        labels = dict(
-            step_number=msg["number"],
-            step_name=msg["name"],
-            builder_id=build_info["builderid"],
-            worker_id=build_info["workerid"],
-        )
+        Steps of a build that arrive while its fetch is still in progress are
+        queued behind that fetch rather than each fetching the build again.
+        The queued steps are dropped if the fetch fails or the build no longer
+        exists.
+        """
+        buildid = msg["buildid"]
+        waiting = self._build_info_pending.get(buildid)
+        if waiting is not None:
+            waiting.append(msg)
+            return None
+        self._build_info_pending[buildid] = [msg]
+        return self._fetchBuildIds(buildid)
 
-        if action == "finished":
-            assert msg["complete"]
-            step_started = msg["started_at"]
-            step_finished = msg["complete_at"]
-            step_duration = step_finished - step_started
-            duration_seconds = step_duration.total_seconds()
-            self.g_steps_duration.labels(**labels).set(duration_seconds)
-
-            step_success = resolve_results_status(msg["results"])
-            if step_success == "success":
-                self.c_steps_success.labels(**labels).inc()
-            elif step_success == "failure":
-                self.c_steps_failure.labels(**labels).inc()
-            elif step_success == "error":
-                self.c_steps_error.labels(**labels).inc()
-
-    def workersConsumer(self, key, msg):
+    @defer.inlineCallbacks
+    def _fetchBuildIds(self, buildid):
+        try:
+            build_info = yield self.master.data.get(("builds", buildid))
+        finally:
+            waiting = self._build_info_pending.pop(buildid)
+            finished = buildid in self._build_info_finished
+            self._build_info_finished.discard(buildid)
+        if build_info is None:
+            # The build has been deleted so its steps cannot be attributed.
+            return
+        build_ids = (build_info["builderid"], build_info["workerid"])
+        # The ids of a finished build are not cached as no event would ever
+        # remove them, leaving them to be evicted by newer builds.
+        if not (finished or build_info.get("complete")):
+            self._build_info_cache[buildid] = build_ids
+            if len(self._build_info_cache) > self.build_info_cache_size:
+                self._build_info_cache.popitem(last=False)
+        for msg in waiting:
+            self._handleStep(msg, build_ids)
+
+    def _handleStep(self, msg, build_ids):
+        duration_seconds = _to_seconds(msg["started_at"], msg["complete_at"])
+        self.h_steps_duration.observe(build_ids, duration_seconds)
+
+        index = _result_position(msg["results"])
+        if index is not None:
+            self._steps_results[index](build_ids)
+            if self._step_names_results is not None:
+                # Step names repeat for every build of a builder. Interning
+                # them keeps a single copy alive in the metrics and lets the
+                # tuple hash reuse the hash already computed for that string.
+                labels = (sys.intern(msg["name"]), build_ids[0])
+                self._step_names_results[index](labels)
+
+    def workersConsumer(self, key, msg, delta):
         """
         This method is responsible for updating worker related metrics. There
         are two worker metrics ``buildbot_workers_running_total`` and
@@ -546,14 +828,10 @@ class Prometheus(service.BuildbotService):
         incremented. When the worker disconnects the same gauge metric is
         decreased. This means that a gauge value of 1 indicates connected while
         a gauge value of 0 indicates disconnected.
-        """
-        action = key[2]
-
-        labels = dict(worker_id=msg["workerid"], worker_name=msg["name"])
 
-        if action == "connected":
-            self.g_workers_running_total.inc()
-            self.g_workers_running.labels(**labels).inc()
-        elif action == "disconnected":
-            self.g_workers_running_total.dec()
-            self.g_workers_running.labels(**labels).dec()
+        The change, delta, is 1 for the connected and -1 for the disconnected
+        action and is bound when the consumer is subscribed.
+        """
+        labels = (msg["workerid"], msg["name"])
+        self._workers_total_inc((), delta)
+        self.g_workers_running.inc(labels, delta)
@@ -0,0 +1,150 @@
+"""
+Twisted web resources used to serve the Prometheus metrics endpoint.
+
+This module is only imported once the reporter service starts so that the
+twisted.web stack is not loaded when buildbot merely imports the plugin.
+"""
+
+import gzip
+import hashlib
+
+from twisted.internet import reactor, threads
+from twisted.python import log
+from twisted.web import http
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+# The content type of the text exposition format written by the collector.
+CONTENT_TYPE = b"text/plain; version=0.0.4; charset=utf-8"
+
+
+class _Rendering:
+    """
+    The output of a render, in plain and gzip compressed form, tagged for
+    conditional requests
+    """
+
+    def __init__(self, body, rendered_at):
+        self.body = body
+        self.gzipped = gzip.compress(body, compresslevel=1)
+        self.rendered_at = rendered_at
+        digest = hashlib.sha1(body).hexdigest()
+        self.etag = f'"{digest}"'.encode("ascii")
+        self.gzip_etag = f'"{digest}-gzip"'.encode("ascii")
+
+
+def _render(collector, snapshot, include_help, rendered_at):
+    """Render a snapshot of the collector. This runs in the threadpool."""
+    body = collector.render_snapshot(snapshot, include_help)
+    return _Rendering(body, rendered_at)
+
+
+class CachedMetricsResource(Resource):
+    """
+    Serve the Prometheus text exposition format rendered by a metrics
+    collector, reusing the rendered output for up to ``ttl`` seconds.
+
+    Rendering is proportional to the number of series, so scrapes arriving
+    within ``ttl`` of the last render, e.g. from several Prometheus replicas,
+    are served the same bytes. The output is tagged with an ETag and a scrape
+    carrying a matching ``If-None-Match`` header is answered with 304 Not
+    Modified.
+
+    Only a snapshot of the metrics is taken on the reactor thread. Rendering
+    the snapshot, and compressing it, is done in the reactor's threadpool so
+    that the reactor keeps dispatching build events while a scrape is being
+    rendered. Scrapes arriving while a render is in progress wait for it
+    rather than starting another.
+
+    The output is gzip compressed for scrapes that accept it. Prometheus
+    accepts gzip by default, so every render is compressed in the threadpool
+    along with rendering it, never on the reactor thread, and its cost is
+    shared by every scrape served from the same render.
+
+    ``# HELP`` lines are left out unless the scrape asks for them with the
+    ``include_help=1`` query argument.
+    """
+
+    isLeaf = True
+
+    def __init__(self, collector, ttl=1.0):
+        Resource.__init__(self)
+        self.collector = collector
+        self.ttl = ttl
+        # The latest rendering with, and without, help lines.
+        self.renderings = {}
+        # The requests waiting for each render in progress.
+        self.waiting = {}
+
+    def render_GET(self, request):
+        include_help = request.args.get(b"include_help") == [b"1"]
+        rendering = self.renderings.get(include_help)
+        if (
+            rendering is not None
+            and reactor.seconds() - rendering.rendered_at < self.ttl
+        ):
+            return self._respond(request, rendering)
+
+        waiting = self.waiting.get(include_help)
+        if waiting is None:
+            d = threads.deferToThread(
+                _render,
+                self.collector,
+                self.collector.snapshot(),
+                include_help,
+                reactor.seconds(),
+            )
+            # Only wait once the render has started, so that a failure to
+            # start it does not leave later scrapes waiting for nothing.
+            waiting = self.waiting[include_help] = []
+            d.addBoth(self._rendered, include_help)
+        waiting.append(request)
+        request.notifyFinish().addErrback(lambda _: waiting.remove(request))
+        return NOT_DONE_YET
+
+    def _rendered(self, result, include_help):
+        """Serve a completed render to the requests waiting for it"""
+        waiting = self.waiting.pop(include_help)
+        failed = not isinstance(result, _Rendering)
+        if failed:
+            log.err(result, "Failed to render Prometheus metrics")
+        else:
+            self.renderings[include_help] = result
+        for request in waiting:
+            if failed:
+                request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+            else:
+                request.write(self._respond(request, result))
+            request.finish()
+
+    def _respond(self, request, rendering):
+        """Set the response headers for a rendering and return the body"""
+        request.setHeader(b"Vary", b"Accept-Encoding")
+        if _accepts_gzip(request):
+            # Each encoding is a distinct representation so has its own tag.
+            if request.setETag(rendering.gzip_etag) == http.CACHED:
+                return b""
+            request.setHeader(b"Content-Encoding", b"gzip")
+            body = rendering.gzipped
+        else:
+            if request.setETag(rendering.etag) == http.CACHED:
+                return b""
+            body = rendering.body
+        request.setHeader(b"Content-Type", CONTENT_TYPE)
+        return body
+
+
+def _accepts_gzip(request):
+    """Return whether the Accept-Encoding header of request allows gzip"""
+    header = request.getHeader(b"accept-encoding")
+    if not header:
+        return False
+    for coding in header.lower().split(b","):
+        name, _, params = coding.partition(b";")
+        if name.strip() == b"gzip":
+            _, _, quality = params.partition(b"q=")
+            try:
+                return not quality or float(quality) > 0
+            except ValueError:
+                return False
+    return False
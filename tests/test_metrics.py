@@ -0,0 +1,117 @@
+from prometheus_client import CollectorRegistry, generate_latest
+from twisted.trial import unittest
+
+from buildbot_prometheus.metrics import Counter, Gauge, Histogram, MetricsCollector
+
+
+class MetricsCollectorTestCase(unittest.TestCase):
+    """Check the exposition written by the collector matches prometheus_client"""
+
+    def setUp(self):
+        self.collector = MetricsCollector()
+        self.registry = CollectorRegistry(auto_describe=False)
+        self.registry.register(self.collector)
+
+    def assertMatchesGenerateLatest(self):
+        self.assertEqual(
+            self.collector.render(include_help=True).decode("utf-8"),
+            generate_latest(self.registry).decode("utf-8"),
+        )
+
+    def test_empty(self):
+        self.assertEqual(self.collector.render(), b"")
+        self.assertMatchesGenerateLatest()
+
+    def test_counter(self):
+        counter = self.collector.add(
+            Counter("test_builds", "Number of builds", labelnames=["builder_id"])
+        )
+        counter.inc((1,))
+        counter.inc((1,))
+        counter.inc((2,), 1234567)
+        counter.ensure((3,))
+        self.assertMatchesGenerateLatest()
+        self.assertIn(
+            b'test_builds_total{builder_id="2"} 1.234567e+06\n', self.collector.render()
+        )
+
+    def test_gauge(self):
+        gauge = self.collector.add(Gauge("test_running", "Number running"))
+        gauge.inc((), 3)
+        gauge.inc((), -1)
+        self.assertMatchesGenerateLatest()
+        self.assertEqual(
+            self.collector.render(),
+            b"# TYPE test_running gauge\ntest_running 2.0\n",
+        )
+
+    def test_gauge_infinite_and_nan(self):
+        gauge = self.collector.add(Gauge("test_value", "A value", labelnames=["n"]))
+        gauge.inc(("inf",), float("inf"))
+        gauge.inc(("-inf",), float("-inf"))
+        gauge.inc(("nan",), float("nan"))
+        self.assertMatchesGenerateLatest()
+
+    def test_label_and_help_escaping(self):
+        counter = self.collector.add(
+            Counter(
+                "test_steps",
+                'Steps with "quotes",\na newline and a \\ backslash',
+                labelnames=["step_name", "builder_id"],
+            )
+        )
+        counter.inc(('say "hi"', 1))
+        counter.inc(("C:\\build\\step", 1))
+        counter.inc(("two\nlines", 1))
+        counter.inc(("unicode \u00e9", 1))
+        self.assertMatchesGenerateLatest()
+
+    def test_histogram(self):
+        histogram = self.collector.add(
+            Histogram(
+                "test_duration",
+                "Duration of builds",
+                labelnames=["worker_id", "builder_id"],
+                buckets=(1, 60, 3600),
+            )
+        )
+        histogram.observe((2, 1), 0.5)
+        histogram.observe((2, 1), 60)
+        histogram.observe((2, 1), 1234567.0)
+        histogram.ensure((3, 1))
+        self.assertMatchesGenerateLatest()
+        self.assertIn(
+            b'test_duration_sum{builder_id="1",worker_id="2"} 1.2346275e+06\n',
+            self.collector.render(),
+        )
+
+    def test_unlabelled_histogram(self):
+        histogram = self.collector.add(
+            Histogram("test_duration", "Duration of builds", buckets=(0.1, 1.5))
+        )
+        for _ in range(1000001):
+            histogram.observe((), 0.05)
+        histogram.observe((), float("inf"))
+        self.assertMatchesGenerateLatest()
+
+    def test_render_snapshot(self):
+        counter = self.collector.add(Counter("test_builds", "Number of builds"))
+        counter.inc()
+        snapshot = self.collector.snapshot()
+        counter.inc()
+        self.assertEqual(
+            self.collector.render_snapshot(snapshot),
+            b"# TYPE test_builds_total counter\ntest_builds_total 1.0\n",
+        )
+
+    def test_expire(self):
+        counter = self.collector.add(
+            Counter("test_builds", "Number of builds", labelnames=["builder_id"])
+        )
+        counter.inc((1,))
+        counter.inc((2,))
+        self.collector.expire(1)
+        counter.inc((2,))
+        self.collector.expire(1)
+        self.assertEqual(list(counter.values), [(2,)])
+        self.assertMatchesGenerateLatest()
@@ -0,0 +1,353 @@
+from buildbot.process.results import FAILURE, RETRY, SUCCESS
+from buildbot.util import service
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from buildbot_prometheus.prometheus import (
+    Prometheus,
+    ResultsStatusMap,
+    _result_position,
+    resolve_results_status,
+)
+
+
+class FakeConsumer:
+    def __init__(self, mq, routingKey):
+        self.mq = mq
+        self.routingKey = routingKey
+
+    def stopConsuming(self):
+        self.mq.live.remove(self)
+
+
+class FakeMQ:
+    """An mq connector failing to start consuming from the failing topics"""
+
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.live = []
+
+    def startConsuming(self, callback, routingKey):
+        if routingKey[0] in self.failing:
+            return defer.fail(RuntimeError(f"cannot consume {routingKey}"))
+        consumer = FakeConsumer(self, routingKey)
+        self.live.append(consumer)
+        return defer.succeed(consumer)
+
+
+class FakeData:
+    """A data connector answering gets from a dict of paths"""
+
+    def __init__(self, paths=None):
+        self.paths = paths or {}
+        self.gets = []
+
+    def get(self, path):
+        self.gets.append(path)
+        result = self.paths[path]
+        if isinstance(result, defer.Deferred):
+            return result
+        if isinstance(result, Exception):
+            return defer.fail(result)
+        return defer.succeed(result)
+
+
+class FakeMaster(service.MasterService):
+    """The master a reporter finds by walking up its service parents"""
+
+    def __init__(self, mq=None, data=None, masterid=1):
+        service.MasterService.__init__(self)
+        self.mq = mq
+        self.data = data
+        self.masterid = masterid
+
+
+def configured_master(mq=None):
+    """
+    Return a fake master with builder 1 configured on worker 2, which is also
+    configured for builder 4 on another master, and an unconfigured worker 3
+    """
+    return FakeMaster(
+        mq=mq or FakeMQ(),
+        data=FakeData(
+            {
+                ("masters", 1, "builders"): [{"builderid": 1, "name": "b1"}],
+                ("masters", 1, "workers"): [
+                    {
+                        "workerid": 2,
+                        "name": "w2",
+                        "configured_on": [
+                            {"builderid": 1, "masterid": 1},
+                            {"builderid": 4, "masterid": 5},
+                        ],
+                    },
+                    {"workerid": 3, "name": "w3", "configured_on": []},
+                ],
+            }
+        ),
+    )
+
+
+class ConsumersTestCase(unittest.TestCase):
+    def setUp(self):
+        self.reporter = Prometheus()
+
+    @defer.inlineCallbacks
+    def test_register_and_remove(self):
+        mq = FakeMQ()
+        yield self.reporter.setServiceParent(FakeMaster(mq))
+        yield self.reporter.registerConsumers()
+        self.assertEqual(len(mq.live), len(self.reporter._handlers))
+        self.assertEqual(self.reporter.consumers, mq.live)
+
+        yield self.reporter.removeConsumers()
+        self.assertEqual(mq.live, [])
+        self.assertEqual(self.reporter.consumers, [])
+
+    @defer.inlineCallbacks
+    def test_register_keeps_started_consumers_on_failure(self):
+        mq = FakeMQ(failing=("steps",))
+        yield self.reporter.setServiceParent(FakeMaster(mq))
+        yield self.assertFailure(self.reporter.registerConsumers(), RuntimeError)
+        self.assertTrue(mq.live)
+        self.assertEqual(self.reporter.consumers, mq.live)
+
+        yield self.reporter.removeConsumers()
+        self.assertEqual(mq.live, [])
+
+
+class ResultPositionTestCase(unittest.TestCase):
+    def test_matches_resolve_results_status(self):
+        positions = {"success": 0, "failure": 1, "error": 2, "pending": None}
+        for results in [*range(-1, max(ResultsStatusMap) + 2), None]:
+            self.assertEqual(
+                _result_position(results),
+                positions[resolve_results_status(results)],
+                results,
+            )
+
+    def test_builds_consumer_counts(self):
+        reporter = Prometheus()
+        msg = {
+            "buildid": 1,
+            "builderid": 2,
+            "workerid": 3,
+            "started_at": 10,
+            "complete_at": 15,
+        }
+        for results in (SUCCESS, RETRY, None, max(ResultsStatusMap) + 1):
+            reporter.buildsConsumer(
+                ("builds", "1", "finished"), {**msg, "results": results}
+            )
+        self.assertEqual(reporter.c_builds_success.values, {(2, 3): 1})
+        self.assertEqual(reporter.c_builds_failure.values, {})
+        self.assertEqual(reporter.c_builds_error.values, {(2, 3): 2})
+        self.assertEqual(reporter.h_builds_duration.values[(2,)][-1], 20)
+
+
+class ExpiryTestCase(unittest.TestCase):
+    def setUp(self):
+        # Each expiry pass removes series idle since the previous one.
+        self.reporter = Prometheus(label_expiry=Prometheus.label_expiry_interval)
+        return self.reporter.setServiceParent(configured_master())
+
+    @defer.inlineCallbacks
+    def test_configured_series_are_kept(self):
+        yield self.reporter._warmLabels()
+        self.reporter.c_builds_success.inc((6, 7))
+        self.reporter.h_builds_duration.observe((1,), 5)
+        for _ in range(3):
+            self.reporter._expireLabels()
+        self.assertEqual(list(self.reporter.c_builds_success.values), [(1, 2)])
+        self.assertEqual(list(self.reporter.c_build_requests_success.values), [(1,)])
+        self.assertEqual(self.reporter.h_builds_duration.values, {})
+
+    def test_default_expiry_is_days(self):
+        self.assertGreaterEqual(Prometheus().label_expiry, 24 * 3600)
+
+
+def step(buildid, name="compile", results=SUCCESS):
+    return {
+        "buildid": buildid,
+        "name": name,
+        "started_at": 10,
+        "complete_at": 12,
+        "results": results,
+    }
+
+
+def build_info(buildid, builderid=1, workerid=2, complete=False):
+    return {
+        "buildid": buildid,
+        "builderid": builderid,
+        "workerid": workerid,
+        "complete": complete,
+    }
+
+
+class StepsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data = FakeData()
+        self.reporter = Prometheus()
+        return self.reporter.setServiceParent(FakeMaster(data=self.data))
+
+    def consume(self, msg):
+        return self.reporter.stepsConsumer(("steps", "1", "finished"), msg)
+
+    def finishBuild(self, buildid):
+        self.reporter.buildsConsumer(
+            ("builds", str(buildid), "finished"),
+            {**build_info(buildid), "started_at": 0, "complete_at": 20, "results": 0},
+        )
+
+    def test_handle_step(self):
+        self.data.paths[("builds", 1)] = build_info(1)
+        self.successResultOf(self.consume(step(1)))
+        self.consume(step(1, results=FAILURE))
+        self.assertEqual(self.data.gets, [("builds", 1)])
+        self.assertEqual(self.reporter.c_steps_success.values, {(1, 2): 1})
+        self.assertEqual(self.reporter.c_steps_failure.values, {(1, 2): 1})
+        self.assertEqual(self.reporter.h_steps_duration.values[(1, 2)][-1], 4)
+
+    def test_steps_wait_for_fetch_in_progress(self):
+        fetch = self.data.paths[("builds", 1)] = defer.Deferred()
+        first = self.consume(step(1))
+        second = self.consume(step(1))
+        self.assertEqual(self.data.gets, [("builds", 1)])
+        self.assertEqual(self.reporter.c_steps_success.values, {})
+
+        fetch.callback(build_info(1))
+        self.successResultOf(first)
+        self.assertIsNone(second)
+        self.assertEqual(self.reporter.c_steps_success.values, {(1, 2): 2})
+        self.assertEqual(self.reporter._build_info_pending, {})
+
+    def test_least_recently_used_build_is_evicted(self):
+        self.reporter.build_info_cache_size = 2
+        for buildid in (1, 2, 3):
+            self.data.paths[("builds", buildid)] = build_info(buildid)
+        self.consume(step(1))
+        self.consume(step(2))
+        self.consume(step(1))
+        self.consume(step(3))
+        self.assertEqual(list(self.reporter._build_info_cache), [1, 3])
+
+    def test_finished_build_is_evicted(self):
+        self.data.paths[("builds", 1)] = build_info(1)
+        self.consume(step(1))
+        self.finishBuild(1)
+        self.assertEqual(self.reporter._build_info_cache, {})
+
+    def test_build_finished_during_fetch_is_not_cached(self):
+        fetch = self.data.paths[("builds", 1)] = defer.Deferred()
+        d = self.consume(step(1))
+        self.finishBuild(1)
+        fetch.callback(build_info(1))
+        self.successResultOf(d)
+        self.assertEqual(self.reporter.c_steps_success.values, {(1, 2): 1})
+        self.assertEqual(self.reporter._build_info_cache, {})
+        self.assertEqual(self.reporter._build_info_finished, set())
+
+    def test_complete_build_is_not_cached(self):
+        self.data.paths[("builds", 1)] = build_info(1, complete=True)
+        self.consume(step(1))
+        self.assertEqual(self.reporter.c_steps_success.values, {(1, 2): 1})
+        self.assertEqual(self.reporter._build_info_cache, {})
+
+    def test_failed_fetch_drops_queued_steps(self):
+        fetch = self.data.paths[("builds", 1)] = defer.Deferred()
+        d = self.consume(step(1))
+        self.consume(step(1))
+        fetch.errback(RuntimeError("data API failed"))
+        self.failureResultOf(d, RuntimeError)
+        self.assertEqual(self.reporter.c_steps_success.values, {})
+        self.assertEqual(self.reporter._build_info_pending, {})
+
+        # The next step of the build fetches it again.
+        self.data.paths[("builds", 1)] = build_info(1)
+        self.consume(step(1))
+        self.assertEqual(self.reporter.c_steps_success.values, {(1, 2): 1})
+
+    def test_deleted_build_drops_steps(self):
+        self.data.paths[("builds", 1)] = None
+        self.successResultOf(self.consume(step(1)))
+        self.assertEqual(self.reporter.c_steps_success.values, {})
+        self.assertEqual(self.reporter._build_info_cache, {})
+
+
+class ReconfigTestCase(unittest.TestCase):
+    @defer.inlineCallbacks
+    def reconfigured(self, master):
+        reporter = Prometheus()
+        yield reporter.setServiceParent(master)
+        yield reporter.reconfigService()
+        return reporter
+
+    @defer.inlineCallbacks
+    def test_warms_configured_builders_and_workers(self):
+        master = configured_master()
+        reporter = yield self.reconfigured(master)
+        self.assertEqual(len(master.mq.live), len(reporter._handlers))
+        for counter in (
+            reporter.c_builds_success,
+            reporter.c_builds_failure,
+            reporter.c_builds_error,
+        ):
+            self.assertEqual(counter.values, {(1, 2): 0.0})
+        for counter in (
+            reporter.c_build_requests_success,
+            reporter.c_build_requests_failure,
+            reporter.c_build_requests_error,
+        ):
+            self.assertEqual(counter.values, {(1,): 0.0})
+        self.assertEqual(reporter.g_builders_running.values, {})
+        self.assertEqual(reporter.g_workers_running.values, {})
+
+    def test_consumer_failure_fails_reconfig(self):
+        master = configured_master(FakeMQ(failing=("steps",)))
+        return self.assertFailure(self.reconfigured(master), RuntimeError)
+
+    @defer.inlineCallbacks
+    def test_warm_failure_does_not_fail_reconfig(self):
+        master = configured_master()
+        master.data.paths[("masters", 1, "workers")] = RuntimeError("data API failed")
+        reporter = yield self.reconfigured(master)
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+        self.assertEqual(len(master.mq.live), len(reporter._handlers))
+
+
+class StepSeriesTestCase(unittest.TestCase):
+    @defer.inlineCallbacks
+    def renderStep(self, **kwargs):
+        reporter = Prometheus(**kwargs)
+        data = FakeData({("builds", 1): build_info(1)})
+        yield reporter.setServiceParent(FakeMaster(data=data))
+        yield reporter.stepsConsumer(("steps", "1", "finished"), step(1))
+        lines = reporter.collector.render().decode("utf-8").splitlines()
+        return [line for line in lines if line.startswith("buildbot_step")]
+
+    @defer.inlineCallbacks
+    def test_steps_labelled_by_builder_and_worker(self):
+        lines = yield self.renderStep()
+        self.assertIn(
+            'buildbot_steps_success_total{builder_id="1",worker_id="2"} 1.0', lines
+        )
+        self.assertIn(
+            'buildbot_steps_duration_seconds_count{builder_id="1",worker_id="2"} 1.0',
+            lines,
+        )
+        self.assertFalse([line for line in lines if "step_name" in line])
+
+    @defer.inlineCallbacks
+    def test_step_name_metrics(self):
+        lines = yield self.renderStep(step_name_metrics=True)
+        self.assertIn(
+            'buildbot_steps_success_total{builder_id="1",worker_id="2"} 1.0', lines
+        )
+        step_names = [line for line in lines if line.startswith("buildbot_step_names")]
+        self.assertEqual(
+            step_names,
+            [
+                'buildbot_step_names_success_total{builder_id="1",step_name="compile"} 1.0'
+            ],
+        )
@@ -0,0 +1,213 @@
+import gzip
+
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+from twisted.web import http
+from twisted.web.test.requesthelper import DummyRequest
+
+from buildbot_prometheus import resources
+from buildbot_prometheus.metrics import Counter, MetricsCollector
+
+
+class Request(DummyRequest):
+    """A DummyRequest answering conditional requests as a real request does"""
+
+    etag = None
+
+    def __init__(self, accept_encoding=None, if_none_match=None, include_help=False):
+        DummyRequest.__init__(self, [b""])
+        if accept_encoding is not None:
+            self.requestHeaders.setRawHeaders(b"accept-encoding", [accept_encoding])
+        if if_none_match is not None:
+            self.requestHeaders.setRawHeaders(b"if-none-match", [if_none_match])
+        if include_help:
+            self.addArg(b"include_help", b"1")
+
+    def setETag(self, etag):
+        return http.Request.setETag(self, etag)
+
+    @property
+    def body(self):
+        return b"".join(self.written)
+
+    def header(self, name):
+        return self.responseHeaders.getRawHeaders(name, [None])[0]
+
+
+class CachedMetricsResourceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(resources, "reactor", self.clock)
+        # Renders are queued rather than handed to a threadpool so that each
+        # test decides when they complete.
+        self.renders = []
+        self.patch(resources.threads, "deferToThread", self.deferToThread)
+
+        self.collector = MetricsCollector()
+        self.counter = self.collector.add(
+            Counter("test_builds", "Number of builds", labelnames=["builder_id"])
+        )
+        self.counter.inc((1,))
+        self.resource = resources.CachedMetricsResource(self.collector, ttl=1.0)
+
+    def deferToThread(self, f, *args):
+        d = defer.Deferred()
+        self.renders.append((d, f, args))
+        return d
+
+    def completeRender(self):
+        d, f, args = self.renders.pop(0)
+        d.callback(f(*args))
+
+    def failRender(self):
+        d, _, _ = self.renders.pop(0)
+        d.errback(Failure(RuntimeError("render failed")))
+
+    def test_render(self):
+        request = Request()
+        request.render(self.resource)
+        self.assertEqual(request.finished, 0)
+        self.completeRender()
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(request.body, self.collector.render())
+        self.assertEqual(request.header(b"content-type"), resources.CONTENT_TYPE)
+        self.assertEqual(request.header(b"vary"), b"Accept-Encoding")
+        self.assertIsNotNone(request.etag)
+
+    def test_scrapes_wait_for_render_in_progress(self):
+        first, second = Request(), Request()
+        first.render(self.resource)
+        second.render(self.resource)
+        self.assertEqual(len(self.renders), 1)
+        self.completeRender()
+        self.assertEqual([first.finished, second.finished], [1, 1])
+        self.assertEqual(first.body, second.body)
+        self.assertEqual(self.resource.waiting, {})
+
+    def test_disconnected_scrape_is_not_answered(self):
+        first, second = Request(), Request()
+        first.render(self.resource)
+        second.render(self.resource)
+        second.processingFailed(Failure(ConnectionError("gone")))
+        self.completeRender()
+        self.assertEqual(first.finished, 1)
+        self.assertEqual(second.finished, 0)
+        self.assertEqual(second.written, [])
+
+    def test_reuse_within_ttl(self):
+        Request().render(self.resource)
+        self.completeRender()
+        self.counter.inc((2,))
+
+        request = Request()
+        request.render(self.resource)
+        self.assertEqual(self.renders, [])
+        self.assertEqual(request.finished, 1)
+        self.assertNotIn(b'builder_id="2"', request.body)
+
+        self.clock.advance(1.0)
+        request = Request()
+        request.render(self.resource)
+        self.completeRender()
+        self.assertIn(b'builder_id="2"', request.body)
+
+    def test_include_help(self):
+        request = Request()
+        request.render(self.resource)
+        self.completeRender()
+        helped = Request(include_help=True)
+        helped.render(self.resource)
+        self.completeRender()
+        self.assertNotIn(b"# HELP", request.body)
+        self.assertEqual(helped.body, self.collector.render(include_help=True))
+
+    def test_not_modified(self):
+        request = Request()
+        request.render(self.resource)
+        self.completeRender()
+
+        conditional = Request(if_none_match=request.etag)
+        conditional.render(self.resource)
+        self.assertEqual(conditional.responseCode, http.NOT_MODIFIED)
+        self.assertEqual(conditional.body, b"")
+
+        self.counter.inc((2,))
+        self.clock.advance(1.0)
+        conditional = Request(if_none_match=request.etag)
+        conditional.render(self.resource)
+        self.completeRender()
+        self.assertNotEqual(conditional.responseCode, http.NOT_MODIFIED)
+        self.assertEqual(conditional.body, self.collector.render())
+
+    def test_gzip(self):
+        plain = Request()
+        plain.render(self.resource)
+        self.completeRender()
+
+        request = Request(accept_encoding=b"deflate, gzip")
+        request.render(self.resource)
+        self.assertEqual(request.header(b"content-encoding"), b"gzip")
+        self.assertEqual(gzip.decompress(request.body), plain.body)
+        self.assertNotEqual(request.etag, plain.etag)
+
+        # The plain tag does not match the compressed representation.
+        conditional = Request(accept_encoding=b"gzip", if_none_match=plain.etag)
+        conditional.render(self.resource)
+        self.assertNotEqual(conditional.responseCode, http.NOT_MODIFIED)
+        conditional = Request(accept_encoding=b"gzip", if_none_match=request.etag)
+        conditional.render(self.resource)
+        self.assertEqual(conditional.responseCode, http.NOT_MODIFIED)
+
+    def test_gzip_refused(self):
+        for accept_encoding in (b"gzip;q=0, deflate", b"identity", b""):
+            request = Request(accept_encoding=accept_encoding)
+            request.render(self.resource)
+            if self.renders:
+                self.completeRender()
+            self.assertIsNone(request.header(b"content-encoding"))
+            self.assertEqual(request.body, self.collector.render())
+
+    def test_render_failure(self):
+        first, second = Request(), Request()
+        first.render(self.resource)
+        second.render(self.resource)
+        self.failRender()
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+        for request in (first, second):
+            self.assertEqual(request.responseCode, http.INTERNAL_SERVER_ERROR)
+            self.assertEqual(request.finished, 1)
+
+        request = Request()
+        request.render(self.resource)
+        self.completeRender()
+        self.assertEqual(request.body, self.collector.render())
+
+    def test_snapshot_failure(self):
+        snapshot = self.collector.snapshot
+        self.patch(self.collector, "snapshot", lambda: 1 / 0)
+        self.assertRaises(ZeroDivisionError, Request().render, self.resource)
+        self.assertEqual(self.resource.waiting, {})
+
+        self.patch(self.collector, "snapshot", snapshot)
+        request = Request()
+        request.render(self.resource)
+        self.completeRender()
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(request.body, self.collector.render())
+
+
+class AcceptsGzipTestCase(unittest.TestCase):
+    def test_accepts_gzip(self):
+        for header, expected in (
+            (None, False),
+            (b"gzip", True),
+            (b"GZIP", True),
+            (b"deflate, gzip;q=0.5", True),
+            (b"gzip;q=0", False),
+            (b"gzip;q=0.0, deflate", False),
+            (b"gzip;q=bad", False),
+            (b"identity", False),
+        ):
+            request = Request(accept_encoding=header)
+            self.assertEqual(resources._accepts_gzip(request), expected, header)